@@ -1,9 +1,8 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib import font_manager
-import os
+import altair as alt
+import duckdb
 
 # =========================================================
 # Page config
@@ -13,22 +12,12 @@ st.set_page_config(
     layout="wide"
 )
 
-# =========================================================
-# Font (cloud-safe)
-# =========================================================
-FONT_PATH = os.path.join("fonts", "NotoSansCJK-Regular.ttc")
-if os.path.exists(FONT_PATH):
-    font_manager.fontManager.addfont(FONT_PATH)
-    plt.rcParams["font.sans-serif"] = ["Noto Sans CJK JP"]
-else:
-    plt.rcParams["font.sans-serif"] = ["DejaVu Sans"]
-plt.rcParams["axes.unicode_minus"] = False
-
 # =========================================================
 # Global constants
 # =========================================================
 SERVE_ACTIONS = [15, 16, 17, 18]
 NON_SERVE_ACTIONS = list(range(0, 15))
+ANNOT_LIMIT = 20
 
 # =========================================================
 # Labels
@@ -48,79 +37,152 @@ spin_label = {
     3:"不旋(No spin)",4:"側上旋(Side top)",5:"側下旋(Side back)"
 }
 
+# Derived label lookups, built once per process and shared across sessions
+@st.cache_resource
+def label_registry():
+    action_labels = [action_label[i] for i in sorted(action_label)]
+    spin_labels = [spin_label[i] for i in sorted(spin_label)]
+    return {
+        "n_spin": len(spin_labels),
+        "c_label_dtype": {
+            True: pd.CategoricalDtype([f"{a} + {s}" for a in action_labels for s in spin_labels]),
+            False: pd.CategoricalDtype(action_labels),
+        },
+    }
+
 # =========================================================
 # Scenario registry
 # =========================================================
 SCENARIOS = {
     "S1": {
         "name": "終局策略（後四拍・含旋轉）",
-        "csv": "data/last4_action_spin.csv",
+        "path": "data/last4_action_spin.parquet",
         "serve_only": False,
         "use_spin": True,
         "player": False,
     },
     "S2": {
         "name": "終局策略（後四拍・不含旋轉）",
-        "csv": "data/last4_action.csv",
+        "path": "data/last4_action.parquet",
         "serve_only": False,
         "use_spin": False,
         "player": False,
     },
     "S3": {
         "name": "發球策略（前三拍・含旋轉）",
-        "csv": "data/serve3_action_spin.csv",
+        "path": "data/serve3_action_spin.parquet",
         "serve_only": True,
         "use_spin": True,
         "player": True,
-        "player_csv": "data/strategy_player_share_A1C_spin.csv",
+        "player_path": "data/strategy_player_share_A1C_spin.parquet",
     },
     "S4": {
         "name": "發球策略（前三拍・不含旋轉）",
-        "csv": "data/serve3_action.csv",
+        "path": "data/serve3_action.parquet",
         "serve_only": True,
         "use_spin": False,
         "player": True,
-        "player_csv": "data/strategy_player_share_A1C.csv",
+        "player_path": "data/strategy_player_share_A1C.parquet",
     },
 }
-player_map_df = pd.read_csv("data/player_id_mapping.csv")
 
 # =========================================================
 # Utils
 # =========================================================
+@st.cache_resource
+def get_player_names():
+    player_map_df = pd.read_parquet("data/player_id_mapping.parquet", engine="pyarrow")
+    return player_map_df.set_index("player_id")["player_name"].to_dict()
+
+# Read-only, so shared across sessions rather than copied per rerun
+@st.cache_resource
+def load_player_groups(path, use_spin):
+    keys = ["A1_actionId","A1_spinId","C_actionId","C_spinId"] if use_spin else ["A1_actionId","C_actionId"]
+    df = pd.read_parquet(path, engine="pyarrow")
+    # Stable sort: rows within a group keep file order
+    return df.set_index(keys).sort_index(kind="stable")
+
+@st.cache_resource
+def duckdb_conn():
+    return duckdb.connect(":memory:")
+
+def query_parquet(sql, params):
+    # One cursor per query: the shared connection is not thread-safe
+    return duckdb_conn().cursor().execute(sql, params).df()
+
 @st.cache_data
-def load_csv(path):
-    return pd.read_csv(path)
+def spin_options(path, A_action):
+    df = query_parquet(
+        f"SELECT DISTINCT A1_spinId FROM read_parquet('{path}') "
+        "WHERE A1_actionId = ? ORDER BY A1_spinId",
+        [int(A_action)]
+    )
+    return df["A1_spinId"].tolist()
 
-def make_c_label(row, use_spin):
+def index_slice(df, key):
+    try:
+        return df.loc[[key]]
+    except KeyError:
+        return df.iloc[0:0]
+
+def make_c_label(df, use_spin, reg):
+    # Label code indexes the c_label_dtype categories directly: no per-row strings
+    codes = df["C_actionId"].to_numpy(np.int16)
     if use_spin:
-        return f"{action_label[row.C_actionId]} + {spin_label[row.C_spinId]}"
-    else:
-        return action_label[row.C_actionId]
+        codes = codes*reg["n_spin"] + df["C_spinId"].to_numpy(np.int16)
+    return pd.Series(
+        pd.Categorical.from_codes(codes, dtype=reg["c_label_dtype"][use_spin]),
+        index=df.index
+    )
 
-def plot_ev_usage(df):
-    df = df.sort_values("EV", ascending=False).reset_index(drop=True)
-    x = np.arange(len(df))
+# Rows come back EV-descending from the query, sorted once per selection
+@st.cache_data
+def filtered_sorted(scenario_key, A_action, A_spin):
+    cfg = SCENARIOS[scenario_key]
+    if cfg["use_spin"] and A_spin is None:
+        # No spin rows for this action: empty slice, caught by the df_sel.empty guard
+        where, params = "FALSE", []
+    elif cfg["use_spin"]:
+        where, params = "A1_actionId = ? AND A1_spinId = ?", [int(A_action), int(A_spin)]
+    else:
+        where, params = "A1_actionId = ?", [int(A_action)]
+    spin_cols = ["A1_spinId", "C_spinId"] if cfg["use_spin"] else []
+    cols = ", ".join(["A1_actionId", "C_actionId"] + spin_cols + ["EV", "usage_rate"])
+    df = query_parquet(
+        f"SELECT {cols} FROM read_parquet('{cfg['path']}') WHERE {where} ORDER BY EV DESC",
+        params
+    )
+    return df.assign(C_label=make_c_label(df, cfg["use_spin"], label_registry()))
 
-    fig, ax1 = plt.subplots(figsize=(14,6))
-    ax1.bar(x, df["EV"])
-    ax1.set_ylim(0,1.05)
-    ax1.set_ylabel("Expected Value (EV)")
+def plot_ev_usage(df, already_sorted=False):
+    if not already_sorted:
+        df = df.sort_values("EV", ascending=False).reset_index(drop=True)
+    chart_df = df[["C_label","EV","usage_rate"]].assign(
+        C_label=df["C_label"].astype(str)
+    )
 
-    for i,v in enumerate(df["EV"]):
-        ax1.text(i, v+0.015, f"{v:.3f}", ha="center", fontsize=9)
+    # Keep the EV-descending row order on the x axis
+    x = alt.X("C_label:N", sort=None, title=None, axis=alt.Axis(labelAngle=-45))
+    base = alt.Chart(chart_df).encode(x=x)
 
-    ax2 = ax1.twinx()
-    ax2.plot(x, df["usage_rate"], color="black", marker="o")
-    ax2.set_ylabel("Usage Rate")
+    ev = base.mark_bar().encode(
+        y=alt.Y("EV:Q", scale=alt.Scale(domain=[0,1.05]), title="Expected Value (EV)")
+    )
+    usage = base.mark_line(point=True, color="black").encode(
+        y=alt.Y("usage_rate:Q", axis=alt.Axis(format="%"), title="Usage Rate")
+    )
 
-    for i,u in enumerate(df["usage_rate"]):
-        ax2.text(i, u+max(df["usage_rate"])*0.03, f"{u*100:.1f}%", ha="center", fontsize=9)
+    # Labels become unreadable past ANNOT_LIMIT bars
+    if len(df) <= ANNOT_LIMIT:
+        ev = ev + ev.mark_text(dy=-8, fontSize=9).encode(
+            text=alt.Text("EV:Q", format=".3f")
+        )
+        usage = usage + usage.mark_text(dy=-10, fontSize=9, color="black").encode(
+            text=alt.Text("usage_rate:Q", format=".1%")
+        )
 
-    ax1.set_xticks(x)
-    ax1.set_xticklabels(df["C_label"], rotation=45, ha="right")
-    plt.tight_layout()
-    st.pyplot(fig)
+    chart = alt.layer(ev, usage).resolve_scale(y="independent").properties(height=450)
+    st.altair_chart(chart, use_container_width=True)
 
 # =========================================================
 # Sidebar
@@ -134,8 +196,6 @@ scenario_key = st.sidebar.radio(
 )
 cfg = SCENARIOS[scenario_key]
 
-df = load_csv(cfg["csv"])
-
 A_action_options = SERVE_ACTIONS if cfg["serve_only"] else NON_SERVE_ACTIONS
 A_action = st.sidebar.selectbox(
     "A_action（先手動作）",
@@ -146,7 +206,7 @@ A_action = st.sidebar.selectbox(
 if cfg["use_spin"]:
     A_spin = st.sidebar.selectbox(
         "A_spin（旋轉）",
-        sorted(df[df.A1_actionId==A_action]["A1_spinId"].unique()),
+        spin_options(cfg["path"], A_action),
         format_func=lambda x: spin_label[x]
     )
 else:
@@ -155,19 +215,12 @@ else:
 # =========================================================
 # Filter EV data
 # =========================================================
-if cfg["use_spin"]:
-    df_sel = df[(df.A1_actionId==A_action)&(df.A1_spinId==A_spin)].copy()
-else:
-    df_sel = df[df.A1_actionId==A_action].copy()
+df_sel = filtered_sorted(scenario_key, A_action, A_spin)
 
 if df_sel.empty:
     st.warning("此條件下沒有資料")
     st.stop()
 
-df_sel["C_label"] = df_sel.apply(
-    lambda r: make_c_label(r, cfg["use_spin"]), axis=1
-)
-
 # =========================================================
 # Main
 # =========================================================
@@ -181,68 +234,58 @@ st.markdown(f"""
 """)
 
 # EV Plot
-plot_ev_usage(df_sel)
-
-# =========================================================
-# Select C_action for player analysis
-# =========================================================
-st.markdown("### 選擇欲分析的後續策略（C_action）")
-
-df_sorted = df_sel.sort_values("EV", ascending=False).reset_index(drop=True)
-c_idx = st.selectbox(
-    "C_action",
-    range(len(df_sorted)),
-    format_func=lambda i: df_sorted.loc[i,"C_label"]
-)
-c_row = df_sorted.loc[c_idx]
+plot_ev_usage(df_sel, already_sorted=True)
 
 # =========================================================
-# Player Top-5 table
+# C_action selection + player analysis
 # =========================================================
-st.subheader("此策略前 5 高使用率選手")
+# Fragment: changing C_action reruns only this block, not the EV chart
+@st.fragment
+def player_analysis(df_sel, cfg, A_action, A_spin):
+    # Select C_action for player analysis
+    st.markdown("### 選擇欲分析的後續策略（C_action）")
+
+    c_idx = st.selectbox(
+        "C_action",
+        range(len(df_sel)),
+        format_func=lambda i: df_sel.loc[i,"C_label"]
+    )
+    c_row = df_sel.loc[c_idx]
 
-if not cfg.get("player", False):
-    st.info("此視角未提供選手行為分析")
-else:
-    pdf = load_csv(cfg["player_csv"])
-    pdf = pdf.merge(
-    player_map_df,
-    left_on="A1_playerId",
-    right_on="player_id",
-    how="left"    )
-
-    if cfg["use_spin"]:
-        pdf = pdf[
-            (pdf.A1_actionId==A_action)&
-            (pdf.A1_spinId==A_spin)&
-            (pdf.C_actionId==c_row.C_actionId)&
-            (pdf.C_spinId==c_row.C_spinId)
-        ]
-    else:
-        pdf = pdf[
-            (pdf.A1_actionId==A_action)&
-            (pdf.C_actionId==c_row.C_actionId)
-        ]
+    # Player Top-5 table
+    st.subheader("此策略前 5 高使用率選手")
 
-    if pdf.empty:
-        st.warning("此策略在選手層級樣本不足")
+    if not cfg.get("player", False):
+        st.info("此視角未提供選手行為分析")
     else:
-        top_players = (
-            pdf.sort_values("usage_share", ascending=False)
-               .head(5)
-               .copy()
-        )
-        top_players["usage_share"] = (top_players["usage_share"]*100).round(2)
-        top_players["win_rate"] = (top_players["win_rate"]*100).round(1)
-
-        st.dataframe(
-            top_players.rename(columns={
-                "player_name":"Player",
-                "use_count":"Use Count",
-                "usage_share":"Usage Rate (%)",
-                "win_rate":"Win Rate (%)"
-            })[
-                ["Player","Use Count","Usage Rate (%)","Win Rate (%)"]
-            ],
-            use_container_width=True
-        )
+        player_table = load_player_groups(cfg["player_path"], cfg["use_spin"])
+
+        if cfg["use_spin"]:
+            key = (A_action, A_spin, c_row.C_actionId, c_row.C_spinId)
+        else:
+            key = (A_action, c_row.C_actionId)
+        pdf = index_slice(player_table, key)
+        if pdf.empty:
+            st.warning("此策略在選手層級樣本不足")
+        else:
+            # Partial selection; ties at the cutoff keep file order
+            top_players = pdf.nlargest(5, "usage_share", keep="first").assign(
+                player_name=lambda d: d["A1_playerId"].map(get_player_names()),
+                usage_share=lambda d: (d["usage_share"]*100).round(2),
+                win_rate=lambda d: (d["win_rate"]*100).round(1)
+            )
+
+            st.dataframe(
+                top_players.rename(columns={
+                    "player_name":"Player",
+                    "use_count":"Use Count",
+                    "usage_share":"Usage Rate (%)",
+                    "win_rate":"Win Rate (%)"
+                })[
+                    ["Player","Use Count","Usage Rate (%)","Win Rate (%)"]
+                ],
+                use_container_width=True,
+                hide_index=True
+            )
+
+player_analysis(df_sel, cfg, A_action, A_spin)
@@ -0,0 +1,18 @@
+# Rebuild data/*.parquet from the CSV sources in data/.
+# Run from the repo root after editing any CSV:  python scripts/csv_to_parquet.py
+import glob
+import os
+
+import pandas as pd
+
+# Compact dtypes: ids fit in int8 (action 0..18, spin 0..5)
+CSV_DTYPES = {
+    "A1_actionId":"int8","A1_spinId":"int8",
+    "C_actionId":"int8","C_spinId":"int8",
+    "EV":"float32","usage_rate":"float32",
+}
+
+for path in sorted(glob.glob(os.path.join("data", "*.csv"))):
+    out = os.path.splitext(path)[0] + ".parquet"
+    pd.read_csv(path, dtype=CSV_DTYPES).to_parquet(out, engine="pyarrow", index=False)
+    print(f"{path} -> {out}")